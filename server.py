@@ -1,15 +1,33 @@
 # server.py (исправленная версия с правильным путем WebSocket)
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, make_response, g
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
 from flask_socketio import SocketIO, emit, join_room, leave_room
 from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy import create_engine, event, func
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import scoped_session, sessionmaker
+import click
+import cProfile
 import jwt
 import datetime
+import glob
+import gzip
+import hashlib
+import hmac
+import inspect
+import io
+import itertools
 import os
+import pstats
 import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict, deque
 from functools import wraps
 import random
+import re
 import string
 from datetime import timezone
 
@@ -82,6 +100,10 @@ class User(db.Model):
 
 class ChatMessage(db.Model):
     __tablename__ = 'chat_message'
+    __table_args__ = (
+        # Комната входит в ключ, чтобы уникальность совпадала с маршрутизацией по шардам
+        db.UniqueConstraint('sender_id', 'room', 'client_message_id', name='uq_chat_message_client_id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     room = db.Column(db.String(50), default='global')
@@ -93,8 +115,12 @@ class ChatMessage(db.Model):
     image_url = db.Column(db.String(500), nullable=True)
     timestamp = db.Column(db.DateTime, default=lambda: datetime.datetime.now(timezone.utc), index=True)
     is_read = db.Column(db.Boolean, default=False)
+    client_message_id = db.Column(db.String(100), nullable=True)  # temp_id клиента для дедупликации
 
-    sender = db.relationship('User', backref=db.backref('messages', lazy=True))
+    @property
+    def sender(self):
+        """Отправитель из основной БД (сообщение может храниться в шарде, где нет таблицы user)"""
+        return User.query.get(self.sender_id)
 
     def to_dict(self):
         return {
@@ -107,7 +133,8 @@ class ChatMessage(db.Model):
             'drawing_url': self.drawing_url,
             'image_url': self.image_url,
             'timestamp': self.timestamp.isoformat(),
-            'is_read': self.is_read
+            'is_read': self.is_read,
+            'temp_id': self.client_message_id
         }
 
 
@@ -124,6 +151,400 @@ class Friend(db.Model):
     friend = db.relationship('User', foreign_keys=[friend_id], backref=db.backref('friends_received', lazy=True))
 
 
+# ==================== Шардирование сообщений ====================
+
+# Количество файлов-шардов для сообщений; 0 - все сообщения в основной БД
+MESSAGE_SHARDS = int(os.environ.get('ARTCHAT_MESSAGE_SHARDS', '0'))
+
+
+def message_shard_path(index):
+    return os.path.join(basedir, f'artchat_messages_{index}.db')
+
+
+def create_shard_engine(path):
+    return create_engine(f'sqlite:///{path}', connect_args={'check_same_thread': False})
+
+
+message_shard_engines = [create_shard_engine(message_shard_path(i)) for i in range(MESSAGE_SHARDS)]
+message_shard_sessions = [scoped_session(sessionmaker(bind=engine)) for engine in message_shard_engines]
+
+# Следующий свободный id сообщения для каждого шарда
+message_id_lock = threading.Lock()
+next_message_ids = {}  # индекс шарда -> id
+
+
+def shard_index(room, shards=None):
+    """Номер шарда комнаты (crc32 стабилен между запусками, в отличие от hash)"""
+    shards = MESSAGE_SHARDS if shards is None else shards
+    return zlib.crc32((room or 'global').encode('utf-8')) % shards
+
+
+def message_session(room):
+    """Сессия БД, в которой хранятся сообщения комнаты"""
+    if not MESSAGE_SHARDS:
+        return db.session
+    return message_shard_sessions[shard_index(room)]
+
+
+def room_messages_query(room):
+    # Все чтения сообщений должны идти через эту функцию, а запись - через
+    # save_message/save_messages: ChatMessage.query привязан к основной БД
+    # и при включенном шардировании не видит сообщений в шардах
+    return message_session(room).query(ChatMessage).filter_by(room=room)
+
+
+def allocate_message_id(index):
+    """Выдает id сообщения для шарда.
+
+    Шард index получает id с остатком index по модулю MESSAGE_SHARDS,
+    поэтому id в разных файлах не пересекаются. Стартовое значение
+    берется больше максимального id во всех хранилищах.
+    """
+    with message_id_lock:
+        if not next_message_ids:
+            max_id = db.session.query(func.max(ChatMessage.id)).scalar() or 0
+            for session in message_shard_sessions:
+                max_id = max(max_id, session.query(func.max(ChatMessage.id)).scalar() or 0)
+
+            for i in range(MESSAGE_SHARDS):
+                candidate = max_id + 1
+                next_message_ids[i] = candidate + (i - candidate) % MESSAGE_SHARDS
+
+        message_id = next_message_ids[index]
+        next_message_ids[index] += MESSAGE_SHARDS
+        return message_id
+
+
+def save_message(message):
+    """Сохраняет сообщение в хранилище его комнаты"""
+    session = message_session(message.room)
+    if MESSAGE_SHARDS:
+        message.id = allocate_message_id(shard_index(message.room))
+
+    try:
+        session.add(message)
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+
+
+def save_messages(messages):
+    """Сохраняет сообщения одной транзакцией на каждое хранилище.
+
+    Хранилища фиксируются независимо, поэтому ошибка в одном шарде не
+    отменяет уже сохраненные группы. Возвращает список (group, exception)
+    для групп, которые сохранить не удалось.
+    """
+    groups = {}
+    for message in messages:
+        session = message_session(message.room)
+        if MESSAGE_SHARDS:
+            message.id = allocate_message_id(shard_index(message.room))
+        groups.setdefault(session, []).append(message)
+
+    failed = []
+    for session, group in groups.items():
+        try:
+            session.add_all(group)
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            failed.append((group, e))
+    return failed
+
+
+# ==================== Идемпотентная отправка ====================
+
+# Недавно сохраненные сообщения: (sender_id, room, client_message_id) -> (время, message_data)
+recent_messages_lock = threading.Lock()
+recent_messages = OrderedDict()
+DEDUPE_WINDOW_SECONDS = 300
+DEDUPE_MAX_ENTRIES = 10000
+CLIENT_MESSAGE_ID_MAX_LENGTH = 100
+
+
+def get_client_message_id(data):
+    """Клиентский id сообщения (client_message_id или temp_id)"""
+    client_message_id = data.get('client_message_id') or data.get('temp_id')
+    return str(client_message_id) if client_message_id else None
+
+
+def remember_message(sender_id, room, client_message_id, message_data):
+    with recent_messages_lock:
+        key = (str(sender_id), room, client_message_id)
+        recent_messages[key] = (time.monotonic(), message_data)
+        recent_messages.move_to_end(key)
+        while len(recent_messages) > DEDUPE_MAX_ENTRIES:
+            recent_messages.popitem(last=False)
+
+
+def find_recent_message(sender_id, room, client_message_id):
+    now = time.monotonic()
+    with recent_messages_lock:
+        # Записи упорядочены по времени, устаревшие находятся в начале
+        while recent_messages:
+            stored_at, _ = next(iter(recent_messages.values()))
+            if now - stored_at < DEDUPE_WINDOW_SECONDS:
+                break
+            recent_messages.popitem(last=False)
+
+        entry = recent_messages.get((str(sender_id), room, client_message_id))
+    return entry[1] if entry else None
+
+
+def submit_message(message):
+    """Сохраняет сообщение, отбрасывая повторы с тем же client_message_id в комнате.
+
+    Повтор в пределах окна дедупликации находится в памяти без обращения
+    к БД; более поздний повтор отсекается уникальным индексом. Возвращает
+    (message_data, duplicate).
+    """
+    client_message_id = message.client_message_id
+    if client_message_id:
+        existing = find_recent_message(message.sender_id, message.room, client_message_id)
+        if existing is not None:
+            return existing, True
+
+    try:
+        save_message(message)
+    except IntegrityError:
+        if not client_message_id:
+            raise
+
+        stored = room_messages_query(message.room) \
+            .filter_by(sender_id=message.sender_id, client_message_id=client_message_id) \
+            .first()
+        if stored is None:
+            raise
+
+        existing = stored.to_dict()
+        remember_message(message.sender_id, message.room, client_message_id, existing)
+        return existing, True
+
+    message_data = message.to_dict()
+    if client_message_id:
+        remember_message(message.sender_id, message.room, client_message_id, message_data)
+    return message_data, False
+
+
+# Максимальное количество сообщений в одном пакете
+MAX_BATCH_MESSAGES = 100
+
+# Необязательные строковые поля элемента пакета
+BATCH_STRING_FIELDS = ('room', 'message_type', 'drawing_url', 'image_url')
+
+
+def submit_message_batch(items, user):
+    """Проверяет и сохраняет пакет сообщений пользователя.
+
+    Новые сообщения записываются одной транзакцией (на каждый шард),
+    повторы по client_message_id не записываются. Возвращает список
+    результатов по каждому элементу и новые сообщения по комнатам.
+    """
+    results = [None] * len(items)
+    pending = []  # (index, message)
+    batch_ids = {}  # (room, client_message_id) -> index первого вхождения в пакете
+    repeats = []  # (index, index первого вхождения)
+
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            results[index] = {'index': index, 'success': False, 'message': 'Неверный формат данных'}
+            continue
+
+        client_message_id = get_client_message_id(item)
+        content = str(item.get('content') or '').strip()
+
+        invalid_fields = [field for field in BATCH_STRING_FIELDS
+                          if item.get(field) is not None and not isinstance(item[field], str)]
+
+        if invalid_fields:
+            error = f'Поле {invalid_fields[0]} должно быть строкой'
+        elif not content:
+            error = 'Сообщение не может быть пустым'
+        elif client_message_id and len(client_message_id) > CLIENT_MESSAGE_ID_MAX_LENGTH:
+            error = 'Слишком длинный client_message_id'
+        else:
+            error = None
+
+        if error:
+            results[index] = {'index': index, 'success': False, 'temp_id': client_message_id, 'message': error}
+            continue
+
+        room = item.get('room') or 'global'
+        if client_message_id:
+            existing = find_recent_message(user.id, room, client_message_id)
+            if existing is not None:
+                results[index] = {'index': index, 'success': True, 'temp_id': client_message_id,
+                                  'duplicate': True, 'data': existing}
+                continue
+
+            if (room, client_message_id) in batch_ids:
+                repeats.append((index, batch_ids[(room, client_message_id)]))
+                continue
+            batch_ids[(room, client_message_id)] = index
+
+        pending.append((index, ChatMessage(
+            room=room,
+            sender_id=user.id,
+            sender_name=user.display_name,
+            message_type=item.get('message_type', 'text'),
+            content=content,
+            drawing_url=item.get('drawing_url'),
+            image_url=item.get('image_url'),
+            timestamp=datetime.datetime.now(timezone.utc),
+            client_message_id=client_message_id
+        )))
+
+    # Повторы, уже сохраненные ранее, ищем одним запросом на комнату
+    client_ids_by_room = {}
+    for index, message in pending:
+        if message.client_message_id:
+            client_ids_by_room.setdefault(message.room, []).append(message.client_message_id)
+
+    stored = {}
+    for room, client_ids in client_ids_by_room.items():
+        for message in room_messages_query(room) \
+                .filter(ChatMessage.sender_id == user.id, ChatMessage.client_message_id.in_(client_ids)) \
+                .all():
+            stored[(room, message.client_message_id)] = message.to_dict()
+
+    new_messages = []
+    for index, message in pending:
+        existing = stored.get((message.room, message.client_message_id))
+        if existing is not None:
+            remember_message(user.id, message.room, message.client_message_id, existing)
+            results[index] = {'index': index, 'success': True, 'temp_id': message.client_message_id,
+                              'duplicate': True, 'data': existing}
+        else:
+            new_messages.append((index, message))
+
+    errors = {}  # id(message) -> ошибка сохранения его группы
+    for group, error in save_messages([message for _, message in new_messages]):
+        for message in group:
+            errors[id(message)] = error
+
+    saved = []
+    for index, message in new_messages:
+        error = errors.get(id(message))
+        if error is None:
+            saved.append((index, message.to_dict(), False))
+            continue
+
+        if isinstance(error, IntegrityError):
+            # Параллельный повтор успел сохранить часть группы: сохраняем по одному
+            message.id = None
+            try:
+                message_data, duplicate = submit_message(message)
+                saved.append((index, message_data, duplicate))
+                continue
+            except Exception as e:
+                error = e
+
+        results[index] = {'index': index, 'success': False, 'temp_id': message.client_message_id,
+                          'message': f'Ошибка сохранения: {str(error)}'}
+
+    by_room = {}
+    for index, message_data, duplicate in saved:
+        if message_data['temp_id']:
+            remember_message(user.id, message_data['room'], message_data['temp_id'], message_data)
+        if not duplicate:
+            by_room.setdefault(message_data['room'], []).append(message_data)
+        results[index] = {'index': index, 'success': True, 'temp_id': message_data['temp_id'],
+                          'duplicate': duplicate, 'data': message_data}
+
+    for index, first_index in repeats:
+        first = results[first_index]
+        results[index] = dict(first, index=index, duplicate=True) if first['success'] else dict(first, index=index)
+
+    return results, by_room
+
+
+def broadcast_message_groups(by_room):
+    """Рассылает новые сообщения одним событием new_messages на комнату"""
+    for room, messages in by_room.items():
+        bump_room_version(room)
+        socketio.emit('new_messages', {'room': room, 'messages': messages}, room=room)
+
+
+@app.teardown_appcontext
+def remove_message_sessions(exception=None):
+    for session in message_shard_sessions:
+        session.remove()
+
+
+def rebalance_messages(target_shards, batch_size=500):
+    """Переносит сообщения между основной БД и target_shards файлами-шардами.
+
+    Выполняется при остановленном сервере. Сообщения копируются с
+    сохранением id, затем удаляются из исходного файла, поэтому повторный
+    запуск после сбоя безопасен. Возвращает число перенесенных сообщений.
+    """
+    sources = [db_path] + sorted(glob.glob(os.path.join(basedir, 'artchat_messages_*.db')))
+    targets = [message_shard_path(i) for i in range(target_shards)] or [db_path]
+
+    engines = {db_path: db.engine}
+    for path in set(sources + targets) - {db_path}:
+        engines[path] = create_shard_engine(path)
+        ChatMessage.__table__.create(engines[path], checkfirst=True)
+
+    sessions = {path: sessionmaker(bind=engine)() for path, engine in engines.items()}
+    columns = [column.name for column in ChatMessage.__table__.columns]
+    moved = 0
+
+    try:
+        for source in sources:
+            source_session = sessions[source]
+            last_id = 0
+
+            while True:
+                batch = source_session.query(ChatMessage) \
+                    .filter(ChatMessage.id > last_id) \
+                    .order_by(ChatMessage.id.asc()) \
+                    .limit(batch_size) \
+                    .all()
+                if not batch:
+                    break
+                last_id = batch[-1].id
+
+                touched = set()
+                for message in batch:
+                    target = targets[shard_index(message.room, len(targets))] if target_shards else db_path
+                    if target == source:
+                        continue
+
+                    sessions[target].merge(ChatMessage(**{name: getattr(message, name) for name in columns}))
+                    source_session.delete(message)
+                    touched.add(target)
+                    moved += 1
+
+                # Сначала фиксируем копии, затем удаление из источника
+                for target in touched:
+                    sessions[target].commit()
+                source_session.commit()
+    finally:
+        for session in sessions.values():
+            session.close()
+        for path, engine in engines.items():
+            if path != db_path:
+                engine.dispose()
+
+    # Лишние шарды после уменьшения их количества пусты
+    for path in set(sources) - set(targets) - {db_path}:
+        os.remove(path)
+
+    return moved
+
+
+@app.cli.command('rebalance-messages')
+@click.argument('shards', type=int)
+def rebalance_messages_command(shards):
+    """Перераспределяет сообщения по SHARDS файлам (0 - в основную БД)"""
+    moved = rebalance_messages(shards)
+    print(f'✅ Перенесено сообщений: {moved}')
+    print(f'   Запускайте сервер с ARTCHAT_MESSAGE_SHARDS={shards}')
+
+
 # Функция для удаления и пересоздания базы данных
 def recreate_database():
     """Удаляет старую базу данных и создает новую с правильной структурой"""
@@ -133,8 +554,14 @@ def recreate_database():
         os.remove(db_path)
         print("🗑️ Старая база данных удалена")
 
+    for path in glob.glob(os.path.join(basedir, 'artchat_messages_*.db')):
+        os.remove(path)
+
     with app.app_context():
         db.create_all()
+        for engine in message_shard_engines:
+            ChatMessage.__table__.create(engine)
+        next_message_ids.clear()
         print("✅ Новая база данных создана")
 
         # Создаем тестового пользователя
@@ -169,21 +596,28 @@ def recreate_database():
         print("   👤 Гость_10001")
 
 
+# Извлечение токена из запроса
+def get_request_token():
+    token = None
+
+    # Проверяем токен в заголовках
+    if 'Authorization' in request.headers:
+        auth_header = request.headers['Authorization']
+        if auth_header.startswith('Bearer '):
+            token = auth_header[7:]  # Убираем 'Bearer '
+
+    # Также проверяем в параметрах запроса
+    if not token and 'token' in request.args:
+        token = request.args.get('token')
+
+    return token
+
+
 # Декоратор для проверки токена
 def token_required(f):
     @wraps(f)
     def decorated(*args, **kwargs):
-        token = None
-
-        # Проверяем токен в заголовках
-        if 'Authorization' in request.headers:
-            auth_header = request.headers['Authorization']
-            if auth_header.startswith('Bearer '):
-                token = auth_header[7:]  # Убираем 'Bearer '
-
-        # Также проверяем в параметрах запроса
-        if not token and 'token' in request.args:
-            token = request.args.get('token')
+        token = get_request_token()
 
         if not token:
             return jsonify({'success': False, 'message': 'Токен отсутствует'}), 401
@@ -230,6 +664,447 @@ def error_response(message, code=400):
     return jsonify({'success': False, 'message': message}), code
 
 
+# ==================== Условные запросы (ETag) ====================
+
+# Счетчики версий данных: ETag вычисляется по ним без обращения к БД
+version_lock = threading.Lock()
+user_versions = {}  # user_id -> версия профиля
+room_versions = {}  # room -> версия истории сообщений
+presence_state = {'epoch': 0}  # версия списков онлайн-пользователей и друзей
+
+# Счетчики живут в памяти, поэтому ETag привязан к запуску сервера
+etag_instance = ''.join(random.choices(string.ascii_lowercase + string.digits, k=8))
+
+# Ответы меньше этого размера не сжимаются
+GZIP_MIN_SIZE = 1024
+
+
+def bump_user_version(user_id):
+    """Отмечает изменение пользователя: его профиля и списков, в которых он виден"""
+    with version_lock:
+        user_versions[user_id] = user_versions.get(user_id, 0) + 1
+        presence_state['epoch'] += 1
+
+    with user_cache_lock:
+        user_cache.pop(user_id, None)
+
+
+def bump_room_version(room):
+    """Отмечает появление новых сообщений в комнате"""
+    with version_lock:
+        room_versions[room] = room_versions.get(room, 0) + 1
+
+
+def conditional_response(etag_key):
+    """Декоратор для GET-эндпоинтов: ETag, ответ 304 и gzip-сжатие.
+
+    etag_key(user_id) возвращает строку версии ответа (или None, если
+    ETag не нужен). Она вычисляется до проверки пользователя в БД,
+    поэтому If-None-Match обслуживается только по JWT и счетчикам версий.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            tag = None
+            token = get_request_token()
+            if token:
+                try:
+                    data = jwt.decode(token, app.config['JWT_SECRET_KEY'], algorithms=["HS256"])
+                    key = etag_key(data['user_id'])
+                    tag = f"{etag_instance}-{key}" if key is not None else None
+                except (jwt.InvalidTokenError, KeyError):
+                    tag = None  # Ошибку вернет token_required
+
+            if tag and request.if_none_match.contains_weak(tag):
+                response = app.response_class(status=304)
+                response.set_etag(tag, weak=True)
+                response.headers['Cache-Control'] = 'private, no-cache'
+                return response
+
+            response = make_response(f(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+
+            if tag:
+                response.set_etag(tag, weak=True)
+                response.headers['Cache-Control'] = 'private, no-cache'
+
+            # Сжимаем крупные ответы, если клиент поддерживает gzip
+            response.vary.add('Accept-Encoding')
+            body = response.get_data()
+            if (request.accept_encodings['gzip'] and len(body) >= GZIP_MIN_SIZE
+                    and 'Content-Encoding' not in response.headers):
+                response.set_data(gzip.compress(body, compresslevel=6))
+                response.headers['Content-Encoding'] = 'gzip'
+
+            return response
+
+        return decorated
+
+    return decorator
+
+
+# ==================== Кэш профилей пользователей ====================
+
+# Снимки User.to_dict() в порядке последнего использования: user_id -> dict
+user_cache_lock = threading.Lock()
+user_cache = OrderedDict()
+USER_CACHE_MAX_ENTRIES = 5000
+
+# Максимальное количество id в одном запросе /api/users/batch
+USER_BATCH_MAX_IDS = 100
+
+
+def get_user_snapshots(user_ids):
+    """Возвращает {user_id: to_dict()} для найденных пользователей.
+
+    Отсутствующие в кэше профили загружаются одним запросом. Кэш
+    сбрасывается для пользователя в bump_user_version.
+    """
+    snapshots = {}
+    missing = []
+    with user_cache_lock:
+        for user_id in user_ids:
+            if user_id in user_cache:
+                user_cache.move_to_end(user_id)
+                snapshots[user_id] = user_cache[user_id]
+            else:
+                missing.append(user_id)
+
+    if not missing:
+        return snapshots
+
+    # Версии до чтения из БД: снимок, изменившийся во время чтения, не кэшируем
+    versions = {user_id: user_versions.get(user_id, 0) for user_id in missing}
+    users = User.query.filter(User.id.in_(missing)).all()
+
+    with user_cache_lock:
+        for user in users:
+            snapshot = user.to_dict()
+            snapshots[user.id] = snapshot
+            if user_versions.get(user.id, 0) == versions[user.id]:
+                user_cache[user.id] = snapshot
+
+        while len(user_cache) > USER_CACHE_MAX_ENTRIES:
+            user_cache.popitem(last=False)
+
+    return snapshots
+
+
+# Поля профиля, которые видит только сам пользователь
+PRIVATE_USER_FIELDS = ('email',)
+
+
+def public_user_snapshot(snapshot):
+    """Снимок профиля без приватных полей для показа другим пользователям"""
+    return {key: value for key, value in snapshot.items() if key not in PRIVATE_USER_FIELDS}
+
+
+def parse_user_ids(value):
+    """Разбирает список id вида '1,2,3' без повторов.
+
+    Бросает ValueError при неверном id или если id больше USER_BATCH_MAX_IDS.
+    """
+    # Читаем лениво не больше лимита непустых элементов: лишний означает превышение.
+    # Пустые элементы (например, после завершающей запятой) в лимит не входят
+    non_empty = (part for part in (match.group().strip() for match in re.finditer(r'[^,]+', value or ''))
+                 if part)
+    parts = list(itertools.islice(non_empty, USER_BATCH_MAX_IDS + 1))
+    if len(parts) > USER_BATCH_MAX_IDS:
+        raise ValueError(f'Не более {USER_BATCH_MAX_IDS} id в запросе')
+
+    user_ids = {}
+    for part in parts:
+        if not part.isdigit():
+            raise ValueError('Неверный id пользователя')
+        user_ids[int(part)] = None
+    return list(user_ids)
+
+
+def users_batch_etag(user_id):
+    try:
+        user_ids = parse_user_ids(request.args.get('ids'))
+    except ValueError:
+        return None
+    if not user_ids:
+        return None
+
+    # Свой профиль отдается с приватными полями, поэтому ETag зависит от вызывающего
+    versions = ','.join(f'{i}:{user_versions.get(i, 0)}' for i in user_ids)
+    return f'users-{user_id}-' + hashlib.sha1(versions.encode('utf-8')).hexdigest()[:16]
+
+
+# ==================== Изменения присутствия ====================
+
+# Накопленные изменения присутствия: user_id -> {'event', 'user'}
+presence_lock = threading.Lock()
+pending_presence = {}
+presence_worker = {'started': False}
+
+# Комната подписчиков на изменения присутствия и интервал рассылки (сек)
+PRESENCE_ROOM = 'presence'
+PRESENCE_BATCH_INTERVAL = 2
+
+# Ограничение размера страницы онлайн-пользователей
+ONLINE_USERS_MAX_LIMIT = 200
+
+
+def queue_presence_change(user, event):
+    """Добавляет изменение присутствия ('joined', 'left', 'updated') в очередь рассылки.
+
+    Изменения одного пользователя за интервал объединяются: 'updated'
+    после 'joined' остается 'joined', после 'left' остается 'left'.
+    """
+    with presence_lock:
+        previous = pending_presence.get(user.id)
+        if event == 'updated' and previous:
+            event = previous['event']
+        pending_presence[user.id] = {
+            'event': event,
+            'user': public_user_snapshot(user.to_dict()) if event != 'left' else None
+        }
+
+
+def flush_presence_changes():
+    """Рассылает подписчикам накопленные изменения одним событием presence_diff"""
+    with presence_lock:
+        changes = dict(pending_presence)
+        pending_presence.clear()
+
+    if not changes:
+        return
+
+    diff = {'joined': [], 'left': [], 'updated': []}
+    for user_id, change in changes.items():
+        if change['event'] == 'left':
+            diff['left'].append(user_id)
+        else:
+            diff[change['event']].append(change['user'])
+
+    diff['epoch'] = presence_state['epoch']
+    diff['timestamp'] = datetime.datetime.now(timezone.utc).isoformat()
+    socketio.emit('presence_diff', diff, room=PRESENCE_ROOM)
+
+
+def presence_flush_loop():
+    """Фоновая задача периодической рассылки изменений присутствия"""
+    while True:
+        socketio.sleep(PRESENCE_BATCH_INTERVAL)
+        try:
+            flush_presence_changes()
+        except Exception as e:
+            print(f'❌ Ошибка рассылки присутствия: {str(e)}')
+
+
+def ensure_presence_worker():
+    """Запускает фоновую рассылку при первой подписке"""
+    with presence_lock:
+        if presence_worker['started']:
+            return
+        presence_worker['started'] = True
+    socketio.start_background_task(presence_flush_loop)
+
+
+# ==================== Профилирование ====================
+
+# Токен администратора; без него эндпоинты /api/admin недоступны
+ADMIN_TOKEN = os.environ.get('ARTCHAT_ADMIN_TOKEN')
+
+PROFILING_MAX_DUMPS = 50
+PROFILING_MAX_QUERIES = 200
+PROFILING_TOP_FUNCTIONS = 40
+
+# targets: 'route:<endpoint>' / 'socket:<обработчик>' -> доля профилируемых вызовов
+# slow_ms: порог медленного запроса для записи SQL, None - выключено
+profiling_lock = threading.Lock()
+profiling_config = {'enabled': False, 'targets': {}, 'slow_ms': None}
+profiling_dumps = deque(maxlen=PROFILING_MAX_DUMPS)
+profiling_dump_ids = itertools.count(1)
+profiling_local = threading.local()
+profiled_engines = []
+profiled_socket_targets = set()  # цели обработчиков с @profile_socket_event
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if getattr(profiling_local, 'state', None) is not None:
+        conn.info.setdefault('profiling_started', []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    state = getattr(profiling_local, 'state', None)
+    started = conn.info.get('profiling_started')
+    if state is None or not started:
+        return
+
+    elapsed_ms = (time.perf_counter() - started.pop()) * 1000
+    state['sql_ms'] += elapsed_ms
+    if len(state['queries']) < PROFILING_MAX_QUERIES:
+        state['queries'].append({'sql': statement, 'ms': round(elapsed_ms, 3)})
+
+
+def update_profiling_listeners():
+    """Подключает слушатели SQL только пока профилирование включено"""
+    enabled = bool(profiling_config['targets']) or profiling_config['slow_ms'] is not None
+
+    if enabled and not profiled_engines:
+        for engine in [db.engine] + message_shard_engines:
+            event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+            event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+            profiled_engines.append(engine)
+    elif not enabled:
+        while profiled_engines:
+            engine = profiled_engines.pop()
+            event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+            event.remove(engine, 'after_cursor_execute', after_cursor_execute)
+
+    profiling_config['enabled'] = enabled
+
+
+def start_profiling(target):
+    """Начинает замер вызова target; None, если он не профилируется"""
+    rate = profiling_config['targets'].get(target)
+    if rate is None and profiling_config['slow_ms'] is None:
+        return None
+
+    profiler = None
+    if rate is not None and random.random() < rate:
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            profiler = None  # В потоке уже работает другой профилировщик
+
+    state = {
+        'target': target,
+        'profiler': profiler,
+        'queries': [],
+        'sql_ms': 0.0,
+        'status': None,
+        'started': time.perf_counter()
+    }
+    profiling_local.state = state
+    return state
+
+
+def finish_profiling(state):
+    """Завершает замер и сохраняет дамп для выборки или медленного вызова"""
+    duration_ms = (time.perf_counter() - state['started']) * 1000
+    profiling_local.state = None
+
+    profiler = state['profiler']
+    if profiler:
+        profiler.disable()
+
+    slow_ms = profiling_config['slow_ms']
+    slow = slow_ms is not None and duration_ms >= slow_ms
+    if not profiler and not slow:
+        return
+
+    profile_text = None
+    if profiler:
+        stream = io.StringIO()
+        pstats.Stats(profiler, stream=stream).sort_stats('cumulative').print_stats(PROFILING_TOP_FUNCTIONS)
+        profile_text = stream.getvalue()
+
+    profiling_dumps.append({
+        'id': next(profiling_dump_ids),
+        'target': state['target'],
+        'timestamp': datetime.datetime.now(timezone.utc).isoformat(),
+        'duration_ms': round(duration_ms, 3),
+        'sql_ms': round(state['sql_ms'], 3),
+        'status': state['status'],
+        'sampled': profiler is not None,
+        'slow': slow,
+        'queries': state['queries'],
+        'profile': profile_text
+    })
+
+
+@app.before_request
+def before_request_profiling():
+    if profiling_config['enabled']:
+        g.profiling = start_profiling(f'route:{request.endpoint}')
+
+
+@app.after_request
+def after_request_profiling(response):
+    state = g.get('profiling')
+    if state:
+        state['status'] = response.status_code
+    return response
+
+
+@app.teardown_request
+def teardown_request_profiling(exception=None):
+    state = g.pop('profiling', None)
+    if state:
+        finish_profiling(state)
+
+
+def profile_socket_event(f):
+    """Профилирование обработчика WebSocket (цель 'socket:<имя функции>')"""
+    target = f'socket:{f.__name__}'
+    profiled_socket_targets.add(target)
+    signature = inspect.signature(f)
+
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        if not profiling_config['enabled']:
+            return f(*args, **kwargs)
+
+        # Flask-SocketIO пробует вызвать connect/disconnect с лишним аргументом
+        # и повторяет вызов без него при TypeError; такую попытку не профилируем
+        try:
+            signature.bind(*args, **kwargs)
+        except TypeError:
+            return f(*args, **kwargs)
+
+        state = start_profiling(target)
+        if state is None:
+            return f(*args, **kwargs)
+
+        try:
+            return f(*args, **kwargs)
+        finally:
+            finish_profiling(state)
+
+    return decorated
+
+
+# Декоратор для эндпоинтов администратора
+def admin_required(f):
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        if not ADMIN_TOKEN:
+            return error_response('Не найдено', 404)
+
+        token = request.headers.get('X-Admin-Token', '')
+        if not hmac.compare_digest(token.encode('utf-8'), ADMIN_TOKEN.encode('utf-8')):
+            return error_response('Доступ запрещен', 403)
+
+        return f(*args, **kwargs)
+
+    return decorated
+
+
+def is_profiling_target(target):
+    """Проверяет, что цель называет существующий эндпоинт или обработчик WebSocket"""
+    if target.startswith('route:'):
+        return target[len('route:'):] in app.view_functions
+    return target in profiled_socket_targets
+
+
+def profiling_summary():
+    return {
+        'enabled': profiling_config['enabled'],
+        'targets': dict(profiling_config['targets']),
+        'slow_ms': profiling_config['slow_ms'],
+        'dumps': [{key: dump[key] for key in ('id', 'target', 'timestamp', 'duration_ms',
+                                               'sql_ms', 'status', 'sampled', 'slow')}
+                  for dump in list(profiling_dumps)]
+    }
+
+
 # ==================== API Routes ====================
 
 @app.route('/api/health', methods=['GET'])
@@ -285,6 +1160,8 @@ def register():
 
         db.session.add(user)
         db.session.commit()
+        bump_user_version(user.id)
+        queue_presence_change(user, 'joined')
 
         # Генерация токена
         token = generate_token(user.id)
@@ -328,6 +1205,8 @@ def login():
         user.is_online = True
         user.last_seen = datetime.datetime.now(timezone.utc)
         db.session.commit()
+        bump_user_version(user.id)
+        queue_presence_change(user, 'joined')
 
         # Генерация токена
         token = generate_token(user.id)
@@ -365,6 +1244,8 @@ def create_guest():
 
         db.session.add(guest_user)
         db.session.commit()
+        bump_user_version(guest_user.id)
+        queue_presence_change(guest_user, 'joined')
 
         # Генерация токена
         token = generate_token(guest_user.id)
@@ -380,6 +1261,7 @@ def create_guest():
 
 
 @app.route('/api/profile', methods=['GET'])
+@conditional_response(lambda user_id: f"profile-{user_id}-{user_versions.get(user_id, 0)}")
 @token_required
 def get_profile(current_user, token):
     try:
@@ -418,6 +1300,9 @@ def update_profile(current_user, token):
             current_user.bio = data['bio']
 
         db.session.commit()
+        bump_user_version(current_user.id)
+        if current_user.is_online:
+            queue_presence_change(current_user, 'updated')
 
         return success_response({
             'user': current_user.to_dict()
@@ -475,6 +1360,8 @@ def logout(current_user, token):
         current_user.is_online = False
         current_user.last_seen = datetime.datetime.now(timezone.utc)
         db.session.commit()
+        bump_user_version(current_user.id)
+        queue_presence_change(current_user, 'left')
 
         return success_response(message='Выход выполнен успешно')
 
@@ -483,12 +1370,14 @@ def logout(current_user, token):
 
 
 @app.route('/api/chat/global/messages', methods=['GET'])
+@conditional_response(lambda user_id: f"room-global-{room_versions.get('global', 0)}-"
+                                      f"{request.args.get('limit', 100, type=int)}")
 @token_required
 def get_global_messages(current_user, token):
     try:
         limit = request.args.get('limit', 100, type=int)
 
-        messages = ChatMessage.query.filter_by(room='global') \
+        messages = room_messages_query('global') \
             .order_by(ChatMessage.timestamp.desc()) \
             .limit(limit) \
             .all()
@@ -514,6 +1403,10 @@ def send_message(current_user, token):
         if not content:
             return error_response('Сообщение не может быть пустым', 400)
 
+        client_message_id = get_client_message_id(data)
+        if client_message_id and len(client_message_id) > CLIENT_MESSAGE_ID_MAX_LENGTH:
+            return error_response('Слишком длинный client_message_id', 400)
+
         # Создание сообщения
         message = ChatMessage(
             room=data.get('room', 'global'),
@@ -523,18 +1416,25 @@ def send_message(current_user, token):
             content=content,
             drawing_url=data.get('drawing_url'),
             image_url=data.get('image_url'),
-            timestamp=datetime.datetime.now(timezone.utc)
+            timestamp=datetime.datetime.now(timezone.utc),
+            client_message_id=client_message_id
         )
 
-        db.session.add(message)
-        db.session.commit()
+        message_data, duplicate = submit_message(message)
+        if duplicate:
+            return success_response({
+                'message': message_data,
+                'duplicate': True
+            }, 'Сообщение уже отправлено')
+
+        bump_room_version(message.room)
 
         # Отправка через WebSocket
-        message_data = message.to_dict()
         socketio.emit('new_message', message_data, room=message.room)
 
         return success_response({
-            'message': message_data
+            'message': message_data,
+            'duplicate': False
         }, 'Сообщение отправлено')
 
     except Exception as e:
@@ -542,15 +1442,114 @@ def send_message(current_user, token):
         return error_response(f'Ошибка сервера: {str(e)}', 500)
 
 
+@app.route('/api/chat/send/batch', methods=['POST'])
+@token_required
+def send_message_batch(current_user, token):
+    """Пакетная отправка сообщений (например, очереди, накопленной офлайн)"""
+    try:
+        data = request.get_json(silent=True)
+
+        if not isinstance(data, dict) or not isinstance(data.get('messages'), list):
+            return error_response('Неверный формат данных', 400)
+
+        items = data['messages']
+        if not items:
+            return error_response('Пакет сообщений пуст', 400)
+        if len(items) > MAX_BATCH_MESSAGES:
+            return error_response(f'Не более {MAX_BATCH_MESSAGES} сообщений в пакете', 400)
+
+        results, by_room = submit_message_batch(items, current_user)
+        broadcast_message_groups(by_room)
+
+        return success_response({
+            'results': results,
+            'accepted': sum(1 for result in results if result['success'])
+        }, 'Пакет сообщений обработан')
+
+    except Exception as e:
+        db.session.rollback()
+        return error_response(f'Ошибка сервера: {str(e)}', 500)
+
+
 @app.route('/api/users/online', methods=['GET'])
+@conditional_response(lambda user_id: f"online-{user_id}-{presence_state['epoch']}-"
+                                      f"{request.args.get('count_only', '')}-"
+                                      f"{request.args.get('limit', '')}-"
+                                      f"{request.args.get('after_id', '')}")
 @token_required
 def get_online_users(current_user, token):
+    """Онлайн пользователи кроме текущего.
+
+    Параметры: count_only=1 - вернуть только количество;
+    limit и after_id - постраничная выдача по возрастанию id (без приватных полей).
+    Без параметров возвращается полный список, как раньше.
+    """
+    try:
+        query = User.query.filter_by(is_online=True).filter(User.id != current_user.id)
+
+        if request.args.get('count_only', '').lower() in ('1', 'true'):
+            return success_response({
+                'total': query.count(),
+                'epoch': presence_state['epoch']
+            })
+
+        limit = request.args.get('limit', type=int)
+        if limit is None:
+            # Получаем всех онлайн пользователей кроме текущего
+            users = query.all()
+
+            return success_response({
+                'users': [user.to_dict() for user in users]
+            })
+
+        limit = max(1, min(limit, ONLINE_USERS_MAX_LIMIT))
+        after_id = request.args.get('after_id', 0, type=int)
+
+        # Берем на одну запись больше, чтобы понять, есть ли следующая страница
+        users = query.filter(User.id > after_id) \
+            .order_by(User.id.asc()) \
+            .limit(limit + 1) \
+            .all()
+        has_more = len(users) > limit
+        users = users[:limit]
+
+        return success_response({
+            'users': [public_user_snapshot(user.to_dict()) for user in users],
+            'total': query.count(),
+            'next_after_id': users[-1].id if has_more else None,
+            'epoch': presence_state['epoch']
+        })
+
+    except Exception as e:
+        return error_response(f'Ошибка сервера: {str(e)}', 500)
+
+
+@app.route('/api/users/batch', methods=['GET'])
+@conditional_response(users_batch_etag)
+@token_required
+def get_users_batch(current_user, token):
+    """Профили пользователей по списку id: /api/users/batch?ids=1,2,3"""
     try:
-        # Получаем всех онлайн пользователей кроме текущего
-        users = User.query.filter_by(is_online=True).filter(User.id != current_user.id).all()
+        try:
+            user_ids = parse_user_ids(request.args.get('ids'))
+        except ValueError as e:
+            return error_response(str(e), 400)
+
+        if not user_ids:
+            return error_response('Укажите id пользователей', 400)
+
+        snapshots = get_user_snapshots(user_ids)
+
+        # Чужие профили отдаются без приватных полей
+        users = []
+        for user_id in user_ids:
+            if user_id in snapshots:
+                snapshot = snapshots[user_id]
+                users.append(snapshot if user_id == current_user.id else public_user_snapshot(snapshot))
 
         return success_response({
-            'users': [user.to_dict() for user in users]
+            'users': users,
+            'missing': [user_id for user_id in user_ids if user_id not in snapshots]
         })
 
     except Exception as e:
@@ -558,6 +1557,7 @@ def get_online_users(current_user, token):
 
 
 @app.route('/api/friends', methods=['GET'])
+@conditional_response(lambda user_id: f"friends-{user_id}-{presence_state['epoch']}")
 @token_required
 def get_friends(current_user, token):
     try:
@@ -567,13 +1567,11 @@ def get_friends(current_user, token):
             (Friend.status == 'accepted')
         ).all()
 
-        friends = []
-        for fs in friendships:
-            friend_id = fs.friend_id if fs.user_id == current_user.id else fs.user_id
-            friend = User.query.get(friend_id)
+        friend_ids = [fs.friend_id if fs.user_id == current_user.id else fs.user_id
+                      for fs in friendships]
+        snapshots = get_user_snapshots(friend_ids)
 
-            if friend:
-                friends.append(friend.to_dict())
+        friends = [snapshots[friend_id] for friend_id in friend_ids if friend_id in snapshots]
 
         return success_response({
             'friends': friends
@@ -583,9 +1581,83 @@ def get_friends(current_user, token):
         return error_response(f'Ошибка сервера: {str(e)}', 500)
 
 
+@app.route('/api/admin/profiling', methods=['GET'])
+@admin_required
+def get_profiling():
+    return success_response(profiling_summary())
+
+
+@app.route('/api/admin/profiling', methods=['PUT'])
+@admin_required
+def update_profiling():
+    """Настройка профилирования.
+
+    targets: {"route:get_friends": 0.1, "socket:handle_send_message": 1}
+    (доля 0 или null отключает цель); slow_ms: порог или null.
+    """
+    data = request.get_json()
+
+    if not data:
+        return error_response('Неверный формат данных', 400)
+
+    targets = data.get('targets', {})
+    if not isinstance(targets, dict):
+        return error_response('targets должен быть объектом', 400)
+
+    for target, rate in targets.items():
+        if not is_profiling_target(target):
+            return error_response(f'Неизвестная цель {target}: нужен route:<endpoint> или socket:<обработчик>', 400)
+        if rate is not None and (isinstance(rate, bool) or not isinstance(rate, (int, float))
+                                 or not 0 <= rate <= 1):
+            return error_response(f'Доля для {target} должна быть от 0 до 1', 400)
+
+    slow_ms = data.get('slow_ms', profiling_config['slow_ms'])
+    if slow_ms is not None and (isinstance(slow_ms, bool) or not isinstance(slow_ms, (int, float))
+                                or slow_ms < 0):
+        return error_response('slow_ms должен быть неотрицательным числом', 400)
+
+    with profiling_lock:
+        new_targets = dict(profiling_config['targets'])
+        for target, rate in targets.items():
+            if rate:
+                new_targets[target] = rate
+            else:
+                new_targets.pop(target, None)
+
+        # Обработчики читают конфигурацию без блокировки, поэтому заменяем словарь целиком
+        profiling_config['targets'] = new_targets
+        profiling_config['slow_ms'] = slow_ms
+        update_profiling_listeners()
+
+    return success_response(profiling_summary(), 'Профилирование обновлено')
+
+
+@app.route('/api/admin/profiling', methods=['DELETE'])
+@admin_required
+def reset_profiling():
+    with profiling_lock:
+        profiling_config['targets'] = {}
+        profiling_config['slow_ms'] = None
+        update_profiling_listeners()
+        profiling_dumps.clear()
+
+    return success_response(profiling_summary(), 'Профилирование выключено')
+
+
+@app.route('/api/admin/profiling/dumps/<int:dump_id>', methods=['GET'])
+@admin_required
+def get_profiling_dump(dump_id):
+    for dump in list(profiling_dumps):
+        if dump['id'] == dump_id:
+            return success_response({'dump': dump})
+
+    return error_response('Дамп не найден', 404)
+
+
 # ==================== WebSocket Events ====================
 
 @socketio.on('connect')
+@profile_socket_event
 def handle_connect():
     """Обработчик подключения WebSocket"""
     print(f'📡 Новое WebSocket подключение: {request.sid}')
@@ -602,6 +1674,7 @@ def handle_connect():
 
 
 @socketio.on('disconnect')
+@profile_socket_event
 def handle_disconnect():
     """Обработчик отключения WebSocket"""
     print(f'📡 WebSocket отключение: {request.sid}')
@@ -617,6 +1690,8 @@ def handle_disconnect():
             user.is_online = False
             user.last_seen = datetime.datetime.now(timezone.utc)
             db.session.commit()
+            bump_user_version(user.id)
+            queue_presence_change(user, 'left')
 
             # Удаляем из активных сессий
             if user_id_str in active_sessions:
@@ -634,6 +1709,7 @@ def handle_disconnect():
 
 
 @socketio.on('join')
+@profile_socket_event
 def handle_join(data):
     """Присоединение пользователя к комнате чата"""
     try:
@@ -656,6 +1732,8 @@ def handle_join(data):
         user.is_online = True
         user.last_seen = datetime.datetime.now(timezone.utc)
         db.session.commit()
+        bump_user_version(user.id)
+        queue_presence_change(user, 'joined')
 
         # Сохраняем информацию о сессии
         active_sessions[str(user_id)] = {
@@ -691,7 +1769,49 @@ def handle_join(data):
         emit('error', {'message': f'Ошибка присоединения: {str(e)}'})
 
 
+@socketio.on('subscribe_presence')
+@profile_socket_event
+def handle_subscribe_presence(data=None):
+    """Подписка на пакетные изменения присутствия (событие presence_diff).
+
+    Требует JWT в поле token.
+    """
+    token = (data or {}).get('token')
+    if not token:
+        emit('error', {'message': 'Токен отсутствует'})
+        return
+
+    try:
+        token_data = jwt.decode(token, app.config['JWT_SECRET_KEY'], algorithms=["HS256"])
+    except jwt.ExpiredSignatureError:
+        emit('error', {'message': 'Срок действия токена истек'})
+        return
+    except jwt.InvalidTokenError:
+        emit('error', {'message': 'Неверный токен'})
+        return
+
+    if not User.query.get(token_data.get('user_id')):
+        emit('error', {'message': 'Пользователь не найден'})
+        return
+
+    join_room(PRESENCE_ROOM)
+    ensure_presence_worker()
+
+    emit('presence_subscribed', {
+        'epoch': presence_state['epoch'],
+        'interval': PRESENCE_BATCH_INTERVAL
+    })
+
+
+@socketio.on('unsubscribe_presence')
+@profile_socket_event
+def handle_unsubscribe_presence(data=None):
+    """Отписка от изменений присутствия"""
+    leave_room(PRESENCE_ROOM)
+
+
 @socketio.on('send_message')
+@profile_socket_event
 def handle_send_message(data):
     """Обработка отправки сообщения"""
     try:
@@ -699,21 +1819,38 @@ def handle_send_message(data):
         room = data.get('room', 'global')
         content = data.get('content', '').strip()
         message_type = data.get('message_type', 'text')
+        client_message_id = get_client_message_id(data)
 
         print(f'💬 Сообщение от {user_id}: {content[:50]}...')
 
         if not content:
-            emit('error', {'message': 'Сообщение не может быть пустым'})
+            emit('error', {'message': 'Сообщение не может быть пустым', 'temp_id': client_message_id})
             return
 
         if not user_id:
-            emit('error', {'message': 'Не указан ID пользователя'})
+            emit('error', {'message': 'Не указан ID пользователя', 'temp_id': client_message_id})
+            return
+
+        if client_message_id and len(client_message_id) > CLIENT_MESSAGE_ID_MAX_LENGTH:
+            emit('error', {'message': 'Слишком длинный client_message_id', 'temp_id': client_message_id})
             return
 
+        # Повтор уже принятого сообщения подтверждаем без обращения к БД
+        if client_message_id:
+            existing = find_recent_message(user_id, room, client_message_id)
+            if existing is not None:
+                emit('ack', {
+                    'id': existing['id'],
+                    'temp_id': client_message_id,
+                    'room': existing['room'],
+                    'duplicate': True
+                })
+                return
+
         # Получаем пользователя
         user = User.query.get(user_id)
         if not user:
-            emit('error', {'message': 'Пользователь не найден'})
+            emit('error', {'message': 'Пользователь не найден', 'temp_id': client_message_id})
             return
 
         # Создание сообщения в БД
@@ -725,23 +1862,76 @@ def handle_send_message(data):
             content=content,
             drawing_url=data.get('drawing_url'),
             image_url=data.get('image_url'),
-            timestamp=datetime.datetime.now(timezone.utc)
+            timestamp=datetime.datetime.now(timezone.utc),
+            client_message_id=client_message_id
         )
 
-        db.session.add(message)
-        db.session.commit()
+        message_data, duplicate = submit_message(message)
+
+        # Подтверждение отправителю с серверным id
+        emit('ack', {
+            'id': message_data['id'],
+            'temp_id': client_message_id,
+            'room': message_data['room'],
+            'duplicate': duplicate
+        })
+
+        if duplicate:
+            return
+
+        bump_room_version(room)
 
         # Отправка сообщения всем в комнате
-        message_data = message.to_dict()
         emit('new_message', message_data, room=room, broadcast=True)
 
-        print(f'✅ Сообщение #{message.id} отправлено в комнату {room}')
+        print(f'✅ Сообщение #{message_data["id"]} отправлено в комнату {room}')
 
     except Exception as e:
         print(f'❌ Ошибка в send_message: {str(e)}')
         emit('error', {'message': f'Ошибка отправки сообщения: {str(e)}'})
 
 
+@socketio.on('send_messages')
+@profile_socket_event
+def handle_send_messages(data):
+    """Пакетная отправка сообщений, результат приходит событием ack_batch"""
+    try:
+        if not isinstance(data, dict):
+            emit('error', {'message': 'Неверный формат данных'})
+            return
+
+        user_id = data.get('user_id')
+        items = data.get('messages')
+
+        if not user_id:
+            emit('error', {'message': 'Не указан ID пользователя'})
+            return
+
+        if not isinstance(items, list) or not items:
+            emit('error', {'message': 'Пакет сообщений пуст'})
+            return
+
+        if len(items) > MAX_BATCH_MESSAGES:
+            emit('error', {'message': f'Не более {MAX_BATCH_MESSAGES} сообщений в пакете'})
+            return
+
+        # Получаем пользователя
+        user = User.query.get(user_id)
+        if not user:
+            emit('error', {'message': 'Пользователь не найден'})
+            return
+
+        results, by_room = submit_message_batch(items, user)
+        emit('ack_batch', {'results': results})
+        broadcast_message_groups(by_room)
+
+        print(f'✅ Пакет из {len(items)} сообщений от {user_id} обработан')
+
+    except Exception as e:
+        print(f'❌ Ошибка в send_messages: {str(e)}')
+        emit('error', {'message': f'Ошибка пакетной отправки: {str(e)}'})
+
+
 # Добавляем тестовый эндпоинт для проверки WebSocket
 @app.route('/socket.io/', methods=['GET'])
 def socket_io_test():
@@ -761,6 +1951,9 @@ if __name__ == '__main__':
     # Пересоздаем базу данных с правильной структурой
     recreate_database()
 
+    if MESSAGE_SHARDS:
+        print(f"🗄️ Сообщения хранятся в {MESSAGE_SHARDS} шардах")
+
     print("""
     🎨 ArtChat Server запущен!
     ===================================
@@ -785,14 +1978,20 @@ if __name__ == '__main__':
     - POST /api/change-password     - Сменить пароль
     - GET  /api/chat/global/messages - История чата
     - POST /api/chat/send           - Отправить сообщение
-    - GET  /api/users/online        - Онлайн пользователи
+    - POST /api/chat/send/batch     - Отправить пакет сообщений
+    - GET  /api/users/online        - Онлайн пользователи (limit, after_id, count_only)
+    - GET  /api/users/batch?ids=    - Профили пользователей по id
     - GET  /api/friends             - Друзья
+    - GET/PUT/DELETE /api/admin/profiling - Профилирование (ARTCHAT_ADMIN_TOKEN)
 
     🔌 WebSocket события:
     - connect      - Подключение
     - disconnect   - Отключение
     - join         - Присоединение к комнате
-    - send_message - Отправка сообщения
+    - send_message - Отправка сообщения (temp_id для дедупликации, ответ ack)
+    - send_messages - Пакетная отправка сообщений (ответ ack_batch)
+    - subscribe_presence   - Подписка на изменения присутствия (presence_diff, нужен token)
+    - unsubscribe_presence - Отписка от изменений присутствия
 
     🚀 Сервер готов к работе!
     """)